@@ -1,11 +1,22 @@
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, Response, stream_with_context
+from flask.sessions import SessionInterface, SessionMixin
+import click
+from werkzeug.datastructures import CallbackDict
 import requests
 import xml.etree.ElementTree as ET
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import urllib.parse
+import itertools
+import csv
+import io
+import uuid
+import math
+import queue
+import threading
 import secrets
 import sqlite3
 import json
+import time
 import os
 from functools import wraps
 
@@ -54,9 +65,98 @@ OSM_API_BASE = 'https://api.openstreetmap.org'
 OSM_AUTH_URL = 'https://www.openstreetmap.org/oauth2/authorize'
 OSM_TOKEN_URL = 'https://www.openstreetmap.org/oauth2/token'
 
+# Время жизни записей кэша пользователей (секунды)
+USER_CACHE_TTL = 300
+# За сколько секунд до истечения токена обновлять его через refresh_token
+TOKEN_REFRESH_MARGIN = 300
+
+OVERPASS_URL = 'https://overpass-api.de/api/interpreter'
+# Минимальный интервал между запросами к Overpass (секунды), общий для всех потоков
+OVERPASS_MIN_INTERVAL = 1.0
+# Фоновая предзагрузка обращается к Overpass реже и только в отсутствие обычных запросов
+OVERPASS_BACKGROUND_MIN_INTERVAL = 3.0
+
+# Размер тайла кэша дорог (градусы, ~1 км) и время жизни тайла (секунды)
+ROAD_TILE_SIZE = 0.01
+ROAD_TILE_TTL = 600
+ROAD_TILE_CACHE_SIZE = 2000
+# Если bbox покрывает больше тайлов, грузим его напрямую без кэша и предзагрузки
+MAX_TILES_PER_REQUEST = 36
+
+# Сеточный индекс дорог для поиска ближайшей дороги к точке
+EARTH_RADIUS_M = 6371000
+ROAD_INDEX_CELL_SIZE_M = 100
+NEAREST_DEFAULT_RADIUS_M = 50
+NEAREST_MAX_RADIUS_M = 500
+NEAREST_MAX_LIMIT = 50
+
+# Ограничение частоты запросов к OSM API при массовой загрузке
+OSM_API_MIN_INTERVAL = 0.5
+# Лимит OSM API на количество элементов в одном changeset
+OSM_CHANGESET_MAX_ELEMENTS = 10000
+IMPORT_WORKERS = 2
+# Сколько дорог запрашивать и отправлять в OSM одним запросом
+IMPORT_UPLOAD_BATCH = 500
+IMPORT_MAX_REPORTED_ERRORS = 100
+
+# Фоновая предзагрузка соседних тайлов
+PREFETCH_WORKERS = 1
+PREFETCH_BUDGET_PER_USER = 16
+PREFETCH_BUDGET_WINDOW = 60
+# Сколько тайлов всего может ждать предзагрузки и через сколько секунд задача устаревает
+PREFETCH_MAX_PENDING = 32
+PREFETCH_MAX_AGE = 30
+
+class TTLCache:
+    """Потокобезопасный in-memory кэш с ограниченным временем жизни записей"""
+    
+    def __init__(self, ttl, max_entries=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._data = {}
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            
+            value, expires_at = item
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            return value
+    
+    def set(self, key, value):
+        with self._lock:
+            now = time.monotonic()
+            if self.max_entries and len(self._data) >= self.max_entries:
+                self._data = {k: v for k, v in self._data.items() if v[1] >= now}
+                # Вытесняем самые старые записи, если просроченных не хватило
+                while len(self._data) >= self.max_entries:
+                    self._data.pop(next(iter(self._data)))
+            
+            self._data[key] = (value, now + self.ttl)
+    
+    def contains(self, key):
+        return self.get(key) is not None
+    
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+    
+    def invalidate_matching(self, predicate):
+        """Удаление записей, значения которых удовлетворяют predicate"""
+        with self._lock:
+            self._data = {
+                key: item for key, item in self._data.items() if not predicate(item[0])
+            }
+
 class DatabaseManager:
     def __init__(self):
         self.db_path = 'osm_editor.db'
+        self.user_cache = TTLCache(USER_CACHE_TTL)
         self.init_database()
     
     def init_database(self):
@@ -103,9 +203,89 @@ class DatabaseManager:
             )
         ''')
         
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS sessions (
+                sid TEXT PRIMARY KEY,
+                data TEXT,
+                expires_at REAL
+            )
+        ''')
+        
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)')
+        
+        # Поля для массового импорта, добавляются и в уже существующие базы
+        self.add_column_if_missing(cursor, 'changesets', 'import_id', 'TEXT')
+        self.add_column_if_missing(cursor, 'road_changes', 'status', "TEXT DEFAULT 'pending'")
+        # Импорт при возобновлении отправляется в новый OSM changeset, поэтому id храним построчно
+        self.add_column_if_missing(cursor, 'road_changes', 'osm_changeset_id', 'INTEGER')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_changesets_import ON changesets (import_id)')
+        
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'tag_edits'")
+        tag_edits_exists = cursor.fetchone() is not None
+        
+        # Индекс правок по отдельным тегам: road_changes хранит теги JSON-строками
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS tag_edits (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                road_change_id INTEGER,
+                changeset_id INTEGER,
+                osm_way_id INTEGER,
+                tag_key TEXT,
+                old_value TEXT,
+                new_value TEXT,
+                FOREIGN KEY (road_change_id) REFERENCES road_changes (id),
+                FOREIGN KEY (changeset_id) REFERENCES changesets (id)
+            )
+        ''')
+        
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tag_edits_way_key ON tag_edits (osm_way_id, tag_key)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tag_edits_key ON tag_edits (tag_key)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_tag_edits_road_change ON tag_edits (road_change_id)')
+        
+        if not tag_edits_exists:
+            self.backfill_tag_edits(conn)
+        
         conn.commit()
         conn.close()
     
+    def backfill_tag_edits(self, conn):
+        """Заполнение индекса правок по уже сохраненным road_changes"""
+        rows = conn.execute('''
+            SELECT rc.id, rc.changeset_id, rc.osm_way_id, rc.old_tags, rc.new_tags
+            FROM road_changes rc
+            JOIN changesets c ON c.id = rc.changeset_id
+            WHERE c.import_id IS NULL OR rc.status = 'sent'
+        ''').fetchall()
+        cursor = conn.cursor()
+        
+        for road_change_id, changeset_id, way_id, old_tags, new_tags in rows:
+            self.index_tag_edits(
+                cursor, road_change_id, changeset_id, way_id,
+                json.loads(old_tags or '{}'), json.loads(new_tags or '{}')
+            )
+    
+    def index_tag_edits(self, cursor, road_change_id, changeset_id, way_id, old_tags, new_tags):
+        """Перестроение записей tag_edits для одного изменения дороги"""
+        cursor.execute('DELETE FROM tag_edits WHERE road_change_id = ?', (road_change_id,))
+        
+        edits = [
+            (road_change_id, changeset_id, way_id, key, old_tags.get(key), value)
+            for key, value in new_tags.items()
+            if old_tags.get(key) != value
+        ]
+        
+        cursor.executemany('''
+            INSERT INTO tag_edits
+            (road_change_id, changeset_id, osm_way_id, tag_key, old_value, new_value)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', edits)
+    
+    def add_column_if_missing(self, cursor, table, column, definition):
+        cursor.execute(f'PRAGMA table_info({table})')
+        columns = [row[1] for row in cursor.fetchall()]
+        if column not in columns:
+            cursor.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+    
     def get_connection(self):
         conn = sqlite3.connect(self.db_path)
         try:
@@ -122,9 +302,15 @@ class DatabaseManager:
         
         try:
             cursor.execute('''
-                INSERT OR REPLACE INTO users 
+                INSERT INTO users 
                 (osm_id, username, display_name, access_token, refresh_token, token_expires_at)
                 VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(osm_id) DO UPDATE SET
+                    username = excluded.username,
+                    display_name = excluded.display_name,
+                    access_token = excluded.access_token,
+                    refresh_token = excluded.refresh_token,
+                    token_expires_at = excluded.token_expires_at
             ''', (
                 user_data['id'],
                 user_data.get('username', ''),
@@ -143,6 +329,7 @@ class DatabaseManager:
                 user_id = cursor.lastrowid
                 
             conn.commit()
+            self.user_cache.invalidate(user_data['id'])
             return user_id
             
         except Exception as e:
@@ -151,7 +338,31 @@ class DatabaseManager:
         finally:
             conn.close()
     
+    def update_user_tokens(self, osm_id, access_token, refresh_token, expires_at):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                UPDATE users
+                SET access_token = ?, refresh_token = ?, token_expires_at = ?
+                WHERE osm_id = ?
+            ''', (access_token, refresh_token, expires_at, osm_id))
+            conn.commit()
+            self.user_cache.invalidate(osm_id)
+            return True
+            
+        except Exception as e:
+            print(f"Ошибка обновления токена пользователя: {e}")
+            return False
+        finally:
+            conn.close()
+    
     def get_user_by_osm_id(self, osm_id):
+        cached = self.user_cache.get(osm_id)
+        if cached is not None:
+            return dict(cached)
+        
         conn = self.get_connection()
         cursor = conn.cursor()
         
@@ -161,10 +372,13 @@ class DatabaseManager:
             
             if user:
                 if isinstance(user, dict):
-                    return user
+                    user = dict(user)
                 else:
                     columns = [description[0] for description in cursor.description]
-                    return dict(zip(columns, user))
+                    user = dict(zip(columns, user))
+                
+                self.user_cache.set(osm_id, user)
+                return dict(user)
             return None
             
         except Exception as e:
@@ -173,30 +387,41 @@ class DatabaseManager:
         finally:
             conn.close()
     
-    def save_changeset(self, user_id, comment, road_changes):
+    def save_changeset(self, user_id, comment, road_changes, import_id=None):
         conn = self.get_connection()
         cursor = conn.cursor()
         
         try:
             cursor.execute('''
-                INSERT INTO changesets (user_id, comment)
-                VALUES (?, ?)
-            ''', (user_id, comment))
+                INSERT INTO changesets (user_id, comment, import_id)
+                VALUES (?, ?, ?)
+            ''', (user_id, comment, import_id))
             
             changeset_id = cursor.lastrowid
             
             for change in road_changes:
+                # Старые теги из OSM есть только у уже отправленных правок (create_changeset);
+                # строки импорта попадают в индекс после отправки, в update_road_changes
+                sent = 'old_tags' in change
+                old_tags = change.get('old_tags', {})
                 cursor.execute('''
                     INSERT INTO road_changes 
-                    (changeset_id, osm_way_id, old_tags, new_tags, change_type)
-                    VALUES (?, ?, ?, ?, ?)
+                    (changeset_id, osm_way_id, old_tags, new_tags, change_type, status)
+                    VALUES (?, ?, ?, ?, ?, ?)
                 ''', (
                     changeset_id,
                     change['way_id'],
-                    json.dumps(change['old_tags']),
+                    json.dumps(old_tags),
                     json.dumps(change['new_tags']),
-                    change.get('change_type', 'modify')
+                    change.get('change_type', 'modify'),
+                    'sent' if sent else 'pending'
                 ))
+                
+                if sent:
+                    self.index_tag_edits(
+                        cursor, cursor.lastrowid, changeset_id, change['way_id'],
+                        old_tags, change['new_tags']
+                    )
             
             conn.commit()
             return changeset_id
@@ -207,8 +432,390 @@ class DatabaseManager:
         finally:
             conn.close()
 
+    def get_import_changesets(self, import_id, user_id=None):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            query = '''
+                SELECT c.*, GROUP_CONCAT(DISTINCT rc.osm_changeset_id) AS osm_changeset_ids
+                FROM changesets c
+                LEFT JOIN road_changes rc ON rc.changeset_id = c.id
+                WHERE c.import_id = ?
+            '''
+            params = [import_id]
+            if user_id is not None:
+                query += ' AND c.user_id = ?'
+                params.append(user_id)
+            
+            cursor.execute(query + ' GROUP BY c.id ORDER BY c.id', params)
+            columns = [description[0] for description in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+            
+        except Exception as e:
+            print(f"Ошибка получения changeset импорта {import_id}: {e}")
+            return []
+        finally:
+            conn.close()
+    
+    def get_import_progress(self, import_id):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                SELECT rc.status, COUNT(*)
+                FROM road_changes rc
+                JOIN changesets c ON c.id = rc.changeset_id
+                WHERE c.import_id = ?
+                GROUP BY rc.status
+            ''', (import_id,))
+            return {row[0]: row[1] for row in cursor.fetchall()}
+            
+        except Exception as e:
+            print(f"Ошибка получения прогресса импорта {import_id}: {e}")
+            return {}
+        finally:
+            conn.close()
+    
+    def get_unsent_road_changes(self, changeset_id):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                SELECT id, osm_way_id, new_tags FROM road_changes
+                WHERE changeset_id = ? AND status NOT IN ('sent', 'superseded')
+                ORDER BY id
+            ''', (changeset_id,))
+            
+            return [
+                {'id': row[0], 'way_id': row[1], 'new_tags': json.loads(row[2])}
+                for row in cursor.fetchall()
+            ]
+            
+        except Exception as e:
+            print(f"Ошибка получения изменений changeset {changeset_id}: {e}")
+            return []
+        finally:
+            conn.close()
+    
+    def update_road_changes(self, updates, osm_changeset_id):
+        """Сохранение результатов отправки: список (road_change_id, old_tags, status, indexed_tags).
+        
+        indexed_tags — теги строки, реально попавшие в OSM (без перезаписанных
+        более поздними строками той же дороги); None — все new_tags строки.
+        """
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            for road_change_id, old_tags, status, indexed_tags in updates:
+                cursor.execute('''
+                    UPDATE road_changes SET old_tags = ?, status = ?, osm_changeset_id = ? WHERE id = ?
+                ''', (
+                    json.dumps(old_tags), status,
+                    osm_changeset_id if status == 'sent' else None, road_change_id
+                ))
+                
+                # Старые значения тегов известны только после загрузки дороги из OSM,
+                # неотправленные изменения в индекс правок не попадают
+                cursor.execute('''
+                    SELECT changeset_id, osm_way_id, new_tags FROM road_changes WHERE id = ?
+                ''', (road_change_id,))
+                changeset_id, way_id, new_tags = cursor.fetchone()
+                if status != 'sent':
+                    new_tags = {}
+                elif indexed_tags is not None:
+                    new_tags = indexed_tags
+                else:
+                    new_tags = json.loads(new_tags)
+                self.index_tag_edits(cursor, road_change_id, changeset_id, way_id, old_tags, new_tags)
+            
+            conn.commit()
+            
+        except Exception as e:
+            print(f"Ошибка обновления изменений дорог: {e}")
+        finally:
+            conn.close()
+    
+    def update_changeset_status(self, changeset_id, status, osm_changeset_id=None):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                UPDATE changesets
+                SET status = ?,
+                    osm_changeset_id = COALESCE(osm_changeset_id, ?),
+                    sent_at = CASE WHEN ? = 'sent' THEN CURRENT_TIMESTAMP ELSE sent_at END
+                WHERE id = ?
+            ''', (status, osm_changeset_id, status, changeset_id))
+            conn.commit()
+            
+        except Exception as e:
+            print(f"Ошибка обновления статуса changeset {changeset_id}: {e}")
+        finally:
+            conn.close()
+
+    def tag_edits_query(self, way_id=None, tag_key=None, after_id=None):
+        query = '''
+            SELECT te.id, te.changeset_id,
+                   COALESCE(rc.osm_changeset_id, c.osm_changeset_id) AS osm_changeset_id, c.status,
+                   te.osm_way_id, te.tag_key, te.old_value, te.new_value,
+                   c.created_at, c.sent_at, u.display_name
+            FROM tag_edits te
+            JOIN changesets c ON c.id = te.changeset_id
+            LEFT JOIN road_changes rc ON rc.id = te.road_change_id
+            LEFT JOIN users u ON u.id = c.user_id
+            WHERE 1 = 1
+        '''
+        params = []
+        
+        if way_id is not None:
+            query += ' AND te.osm_way_id = ?'
+            params.append(way_id)
+        if tag_key:
+            query += ' AND te.tag_key = ?'
+            params.append(tag_key)
+        if after_id:
+            query += ' AND te.id > ?'
+            params.append(after_id)
+        
+        return query + ' ORDER BY te.id', params
+    
+    def get_tag_edits(self, way_id=None, tag_key=None, after_id=None, limit=100):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            query, params = self.tag_edits_query(way_id, tag_key, after_id)
+            cursor.execute(query + ' LIMIT ?', params + [limit])
+            columns = [description[0] for description in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+            
+        except Exception as e:
+            print(f"Ошибка получения истории правок: {e}")
+            return []
+        finally:
+            conn.close()
+    
+    def iter_tag_edits(self, way_id=None, tag_key=None, batch_size=500):
+        """Потоковое чтение истории правок порциями, без загрузки в память целиком"""
+        after_id = 0
+        
+        while True:
+            # Новое короткое соединение на каждую порцию: открытый курсор держал бы
+            # блокировку чтения и не давал другим соединениям записывать
+            conn = self.get_connection()
+            cursor = conn.cursor()
+            
+            try:
+                query, params = self.tag_edits_query(way_id, tag_key, after_id)
+                cursor.execute(query + ' LIMIT ?', params + [batch_size])
+                columns = [description[0] for description in cursor.description]
+                rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+            finally:
+                conn.close()
+            
+            yield from rows
+            
+            if len(rows) < batch_size:
+                break
+            after_id = rows[-1]['id']
+
+    def load_session(self, sid):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute(
+                'SELECT data FROM sessions WHERE sid = ? AND expires_at > ?',
+                (sid, time.time())
+            )
+            row = cursor.fetchone()
+            
+            if row:
+                return json.loads(row['data'] if isinstance(row, dict) else row[0])
+            return None
+            
+        except Exception as e:
+            print(f"Ошибка загрузки сессии: {e}")
+            return None
+        finally:
+            conn.close()
+    
+    def save_session(self, sid, data, expires_at):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('''
+                INSERT OR REPLACE INTO sessions (sid, data, expires_at)
+                VALUES (?, ?, ?)
+            ''', (sid, json.dumps(data), expires_at))
+            
+            cursor.execute('DELETE FROM sessions WHERE expires_at <= ?', (time.time(),))
+            conn.commit()
+            
+        except Exception as e:
+            print(f"Ошибка сохранения сессии: {e}")
+        finally:
+            conn.close()
+    
+    def delete_session(self, sid):
+        conn = self.get_connection()
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute('DELETE FROM sessions WHERE sid = ?', (sid,))
+            conn.commit()
+            
+        except Exception as e:
+            print(f"Ошибка удаления сессии: {e}")
+        finally:
+            conn.close()
+
 db = DatabaseManager()
 
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Сессия, данные которой хранятся на сервере, а в cookie лежит только её id"""
+    
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        
+        CallbackDict.__init__(self, initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.old_sid = None
+    
+    def regenerate(self):
+        """Выдать новый id сессии (после входа, против фиксации сессии)"""
+        self.old_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+class SQLiteSessionInterface(SessionInterface):
+    """Хранение сессий в таблице sessions вместо подписанной cookie"""
+    
+    def __init__(self, database):
+        self.db = database
+    
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.db.load_session(sid)
+            if data is not None:
+                return ServerSideSession(data, sid=sid)
+        
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+    
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        
+        if session.old_sid:
+            self.db.delete_session(session.old_sid)
+        
+        if not session:
+            if session.modified:
+                self.db.delete_session(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        
+        if not self.should_set_cookie(app, session):
+            return
+        
+        expires = self.get_expiration_time(app, session)
+        stored_until = time.time() + app.permanent_session_lifetime.total_seconds()
+        self.db.save_session(session.sid, dict(session), stored_until)
+        
+        response.set_cookie(
+            name,
+            session.sid,
+            expires=expires,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app)
+        )
+
+app.session_interface = SQLiteSessionInterface(db)
+
+def token_expires_at(token_response):
+    """Момент истечения токена в ISO-формате (UTC) или None"""
+    expires_in = token_response.get('expires_in')
+    if not expires_in:
+        return None
+    return (datetime.now(timezone.utc) + timedelta(seconds=int(expires_in))).isoformat()
+
+def refresh_access_token(user_db):
+    """Обновление access_token через сохранённый refresh_token"""
+    token_data = {
+        'client_id': OSM_CLIENT_ID,
+        'client_secret': OSM_CLIENT_SECRET,
+        'grant_type': 'refresh_token',
+        'refresh_token': user_db['refresh_token']
+    }
+    
+    try:
+        response = requests.post(OSM_TOKEN_URL, data=token_data, timeout=30)
+        response.raise_for_status()
+        token_response = response.json()
+        
+        access_token = token_response['access_token']
+        db.update_user_tokens(
+            user_db['osm_id'],
+            access_token,
+            token_response.get('refresh_token', user_db['refresh_token']),
+            token_expires_at(token_response)
+        )
+        return access_token
+        
+    except Exception as e:
+        print(f"Ошибка обновления токена: {e}")
+        return None
+
+def get_access_token(osm_id):
+    """Токен пользователя из кэша/БД, обновлённый заранее, если скоро истечёт"""
+    user_db = db.get_user_by_osm_id(osm_id)
+    if not user_db:
+        return None
+    
+    expires_at = user_db.get('token_expires_at')
+    if expires_at and user_db.get('refresh_token'):
+        try:
+            expires = datetime.fromisoformat(str(expires_at))
+            if expires.tzinfo is None:
+                expires = expires.replace(tzinfo=timezone.utc)
+            
+            if expires - datetime.now(timezone.utc) < timedelta(seconds=TOKEN_REFRESH_MARGIN):
+                return refresh_access_token(user_db) or user_db['access_token']
+        except ValueError:
+            pass
+    
+    return user_db['access_token']
+
+def parse_way_element(way_elem):
+    way_data = {
+        'id': way_elem.get('id'),
+        'version': way_elem.get('version'),
+        'tags': {},
+        'nodes': []
+    }
+    
+    for tag in way_elem.findall('tag'):
+        way_data['tags'][tag.get('k')] = tag.get('v')
+    
+    for nd in way_elem.findall('nd'):
+        way_data['nodes'].append(nd.get('ref'))
+    
+    return way_data
+
 class OSMAPIClient:
     def __init__(self, access_token=None):
         self.access_token = access_token
@@ -246,79 +853,586 @@ class OSMAPIClient:
   </changeset>
 </osm>'''
         
-        try:
-            response = self.session.put(
-                f'{OSM_API_BASE}/api/0.6/changeset/create',
-                data=changeset_xml,
-                headers={'Content-Type': 'text/xml'}
-            )
-            response.raise_for_status()
-            return int(response.text)
-        except Exception as e:
-            print(f"Ошибка создания changeset: {e}")
-            return None
+        try:
+            response = self.session.put(
+                f'{OSM_API_BASE}/api/0.6/changeset/create',
+                data=changeset_xml,
+                headers={'Content-Type': 'text/xml'}
+            )
+            response.raise_for_status()
+            return int(response.text)
+        except Exception as e:
+            print(f"Ошибка создания changeset: {e}")
+            return None
+    
+    def get_way(self, way_id):
+        try:
+            response = self.session.get(f'{OSM_API_BASE}/api/0.6/way/{way_id}')
+            response.raise_for_status()
+            
+            root = ET.fromstring(response.text)
+            return parse_way_element(root.find('way'))
+        except Exception as e:
+            print(f"Ошибка получения дороги {way_id}: {e}")
+            return None
+    
+    def get_ways(self, way_ids):
+        """Загрузка нескольких дорог одним запросом: {way_id: way_data} или None при ошибке"""
+        try:
+            response = self.session.get(
+                f'{OSM_API_BASE}/api/0.6/ways',
+                params={'ways': ','.join(str(way_id) for way_id in way_ids)}
+            )
+            response.raise_for_status()
+            
+            root = ET.fromstring(response.text)
+            return {
+                int(way_elem.get('id')): parse_way_element(way_elem)
+                for way_elem in root.findall('way')
+                if way_elem.get('visible') != 'false'
+            }
+        except Exception as e:
+            # В том числе 404, если хотя бы одной дороги из списка нет
+            print(f"Ошибка получения дорог: {e}")
+            return None
+    
+    def way_xml(self, changeset_id, way_data):
+        way_xml = f'''  <way id="{way_data['id']}" version="{way_data['version']}" changeset="{changeset_id}">
+'''
+        
+        for node_id in way_data['nodes']:
+            way_xml += f'    <nd ref="{node_id}" />\n'
+        
+        for key, value in way_data['tags'].items():
+            value_escaped = value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+            way_xml += f'    <tag k="{key}" v="{value_escaped}" />\n'
+        
+        return way_xml + '  </way>\n'
+    
+    def update_way(self, changeset_id, way_data):
+        way_xml = f'''<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6" generator="OSM-Lane-Editor">
+{self.way_xml(changeset_id, way_data)}</osm>'''
+        
+        try:
+            response = self.session.put(
+                f'{OSM_API_BASE}/api/0.6/way/{way_data["id"]}',
+                data=way_xml,
+                headers={'Content-Type': 'text/xml'}
+            )
+            response.raise_for_status()
+            return int(response.text)
+        except Exception as e:
+            print(f"Ошибка обновления дороги {way_data['id']}: {e}")
+            return None
+    
+    def upload_changes(self, changeset_id, ways):
+        """Отправка изменений нескольких дорог одним osmChange-документом (атомарно)"""
+        change_xml = '''<?xml version="1.0" encoding="UTF-8"?>
+<osmChange version="0.6" generator="OSM-Lane-Editor">
+<modify>
+'''
+        for way_data in ways:
+            change_xml += self.way_xml(changeset_id, way_data)
+        change_xml += '</modify>\n</osmChange>'
+        
+        try:
+            response = self.session.post(
+                f'{OSM_API_BASE}/api/0.6/changeset/{changeset_id}/upload',
+                data=change_xml.encode('utf-8'),
+                headers={'Content-Type': 'text/xml'}
+            )
+            response.raise_for_status()
+            return True
+        except Exception as e:
+            print(f"Ошибка загрузки изменений в changeset {changeset_id}: {e}")
+            return False
+    
+    def close_changeset(self, changeset_id):
+        try:
+            response = self.session.put(f'{OSM_API_BASE}/api/0.6/changeset/{changeset_id}/close')
+            response.raise_for_status()
+            return True
+        except Exception as e:
+            print(f"Ошибка закрытия changeset {changeset_id}: {e}")
+            return False
+
+class RateLimiter:
+    """Ограничение частоты запросов: не чаще одного раза в min_interval секунд.
+    
+    Фоновые вызовы уступают очередь: берут слот, только когда никто из обычных
+    вызовов не ждет, и не чаще одного раза в background_interval секунд.
+    """
+    
+    def __init__(self, min_interval, background_interval=None):
+        self.min_interval = min_interval
+        self.background_interval = background_interval or min_interval
+        self._last_slot = float('-inf')
+        self._foreground_waiting = 0
+        self._condition = threading.Condition()
+    
+    def wait(self, background=False):
+        interval = self.background_interval if background else self.min_interval
+        
+        with self._condition:
+            if not background:
+                self._foreground_waiting += 1
+            
+            try:
+                while True:
+                    now = time.monotonic()
+                    ready_at = self._last_slot + interval
+                    blocked = background and self._foreground_waiting > 0
+                    
+                    if not blocked and now >= ready_at:
+                        self._last_slot = now
+                        return
+                    
+                    self._condition.wait(None if blocked else ready_at - now)
+            finally:
+                if not background:
+                    self._foreground_waiting -= 1
+                    self._condition.notify_all()
+
+overpass_limiter = RateLimiter(OVERPASS_MIN_INTERVAL, OVERPASS_BACKGROUND_MIN_INTERVAL)
+road_tile_cache = TTLCache(ROAD_TILE_TTL, max_entries=ROAD_TILE_CACHE_SIZE)
+
+def fetch_roads_from_overpass(bbox, background=False):
+    """Загрузка дорог в bbox (south, west, north, east) из Overpass API"""
+    query = f"""
+        [out:json][timeout:25];
+        (
+          way["highway"]({bbox[0]},{bbox[1]},{bbox[2]},{bbox[3]});
+        );
+        out geom;
+        """
+    
+    headers = {'User-Agent': 'OSM-Lane-Editor/1.0'}
+    
+    overpass_limiter.wait(background)
+    response = requests.post(OVERPASS_URL, data=query, timeout=30, headers=headers)
+    response.raise_for_status()
+    overpass_data = response.json()
+    
+    roads = []
+    
+    for element in overpass_data.get('elements', []):
+        if element.get('type') == 'way' and 'geometry' in element:
+            geometry = element.get('geometry', [])
+            if len(geometry) < 2:
+                continue
+                
+            tags = element.get('tags', {})
+            highway_type = tags.get('highway', '')
+            
+            if highway_type in ['footway', 'path', 'steps', 'cycleway']:
+                continue
+            
+            road = {
+                'id': element['id'],
+                'type': 'way',
+                'geometry': geometry,
+                'tags': tags
+            }
+            
+            roads.append(road)
+    
+    return roads
+
+def tile_bounds(tile):
+    """Границы тайла (row, col) в виде bbox (south, west, north, east)"""
+    row, col = tile
+    return [
+        round(row * ROAD_TILE_SIZE, 6),
+        round(col * ROAD_TILE_SIZE, 6),
+        round((row + 1) * ROAD_TILE_SIZE, 6),
+        round((col + 1) * ROAD_TILE_SIZE, 6)
+    ]
+
+def tile_range_for_bbox(bbox):
+    """Диапазон тайлов (min_row, min_col, max_row, max_col), покрывающих bbox"""
+    return (
+        math.floor(bbox[0] / ROAD_TILE_SIZE),
+        math.floor(bbox[1] / ROAD_TILE_SIZE),
+        math.floor(bbox[2] / ROAD_TILE_SIZE),
+        math.floor(bbox[3] / ROAD_TILE_SIZE)
+    )
+
+def tiles_in_range(tile_range):
+    min_row, min_col, max_row, max_col = tile_range
+    return [
+        (row, col)
+        for row in range(min_row, max_row + 1)
+        for col in range(min_col, max_col + 1)
+    ]
+
+def group_tiles(tiles):
+    """Разбиение набора тайлов на прямоугольники из соседних тайлов (жадно, по строкам)"""
+    remaining = set(tiles)
+    ranges = []
+    
+    for row, col in sorted(tiles):
+        if (row, col) not in remaining:
+            continue
+        
+        max_col = col
+        while (row, max_col + 1) in remaining:
+            max_col += 1
+        
+        max_row = row
+        while all((max_row + 1, c) in remaining for c in range(col, max_col + 1)):
+            max_row += 1
+        
+        tile_range = (row, col, max_row, max_col)
+        remaining.difference_update(tiles_in_range(tile_range))
+        ranges.append(tile_range)
+    
+    return ranges
+
+def fetch_road_tiles(tiles, background=False):
+    """Загрузка тайлов из Overpass (запрос на каждый прямоугольник соседних тайлов) в кэш"""
+    by_tile = {}
+    
+    # Запрашиваем только недостающие тайлы, а не весь охватывающий их прямоугольник
+    for tile_range in group_tiles(tiles):
+        min_row, min_col, max_row, max_col = tile_range
+        south, west = tile_bounds((min_row, min_col))[:2]
+        north, east = tile_bounds((max_row, max_col))[2:]
+        
+        roads = fetch_roads_from_overpass([south, west, north, east], background)
+        
+        range_tiles = {tile: [] for tile in tiles_in_range(tile_range)}
+        for road in roads:
+            lats = [point['lat'] for point in road['geometry']]
+            lons = [point['lon'] for point in road['geometry']]
+            road_range = tile_range_for_bbox([min(lats), min(lons), max(lats), max(lons)])
+            
+            # Дорога попадает во все тайлы, пересекающие её bbox (с запасом, но без пропусков)
+            for tile in tiles_in_range(road_range):
+                if tile in range_tiles:
+                    range_tiles[tile].append(road)
+        
+        for tile, tile_roads in range_tiles.items():
+            road_tile_cache.set(tile, tile_roads)
+        by_tile.update(range_tiles)
+    
+    return by_tile
+
+def segment_intersects_bbox(a, b, bbox):
+    """Пересекает ли отрезок (lat, lon)-(lat, lon) прямоугольник (отсечение Лианга-Барски)"""
+    t_min, t_max = 0.0, 1.0
+    d_lat = b[0] - a[0]
+    d_lon = b[1] - a[1]
+    
+    for p, q in (
+        (-d_lat, a[0] - bbox[0]), (d_lat, bbox[2] - a[0]),
+        (-d_lon, a[1] - bbox[1]), (d_lon, bbox[3] - a[1])
+    ):
+        if p == 0:
+            if q < 0:
+                return False
+            continue
+        
+        t = q / p
+        if p < 0:
+            t_min = max(t_min, t)
+        else:
+            t_max = min(t_max, t)
+        if t_min > t_max:
+            return False
+    
+    return True
+
+def road_intersects_bbox(road, bbox):
+    """Проходит ли геометрия дороги через bbox (south, west, north, east)"""
+    points = [(point['lat'], point['lon']) for point in road['geometry']]
+    return any(segment_intersects_bbox(a, b, bbox) for a, b in zip(points, points[1:]))
+
+def invalidate_road_tiles(way_ids):
+    """Сброс из кэша только тех тайлов, в которых есть указанные дороги"""
+    way_ids = {int(way_id) for way_id in way_ids}
+    if way_ids:
+        road_tile_cache.invalidate_matching(
+            lambda roads: any(road['id'] in way_ids for road in roads)
+        )
+
+def load_road_tiles(tiles):
+    """Дороги для набора тайлов: из кэша, недостающие тайлы догружаются из Overpass"""
+    by_tile = {}
+    missing = []
+    
+    for tile in tiles:
+        cached = road_tile_cache.get(tile)
+        if cached is None:
+            missing.append(tile)
+        else:
+            by_tile[tile] = cached
+    
+    if missing:
+        by_tile.update(fetch_road_tiles(missing))
+    
+    roads = []
+    seen = set()
+    for tile in tiles:
+        for road in by_tile[tile]:
+            if road['id'] not in seen:
+                seen.add(road['id'])
+                roads.append(road)
+    
+    return roads
+
+class RoadTileIndex:
+    """Сеточный индекс отрезков дорог одного тайла в локальной метрической проекции"""
+    
+    def __init__(self, tile, roads):
+        south, west, north, east = tile_bounds(tile)
+        self.source = roads
+        self.south = south
+        self.west = west
+        self.m_per_deg_lat = math.radians(1) * EARTH_RADIUS_M
+        self.m_per_deg_lon = self.m_per_deg_lat * math.cos(math.radians((south + north) / 2))
+        self.cols = math.ceil((east - west) * self.m_per_deg_lon / ROAD_INDEX_CELL_SIZE_M)
+        self.rows = math.ceil((north - south) * self.m_per_deg_lat / ROAD_INDEX_CELL_SIZE_M)
+        self.roads = {road['id']: road for road in roads}
+        self.cells = {}
+        
+        for road in roads:
+            points = [self.project(point['lat'], point['lon']) for point in road['geometry']]
+            for (ax, ay), (bx, by) in zip(points, points[1:]):
+                dx, dy = bx - ax, by - ay
+                segment = (road['id'], ax, ay, dx, dy, dx * dx + dy * dy)
+                for cell in self.cells_in_box(min(ax, bx), min(ay, by), max(ax, bx), max(ay, by)):
+                    self.cells.setdefault(cell, []).append(segment)
+    
+    def project(self, lat, lon):
+        return (lon - self.west) * self.m_per_deg_lon, (lat - self.south) * self.m_per_deg_lat
+    
+    def unproject(self, x, y):
+        return self.south + y / self.m_per_deg_lat, self.west + x / self.m_per_deg_lon
+    
+    def cells_in_box(self, min_x, min_y, max_x, max_y):
+        """Ячейки сетки, пересекающие прямоугольник (только в пределах тайла)"""
+        min_col = max(math.floor(min_x / ROAD_INDEX_CELL_SIZE_M), 0)
+        min_row = max(math.floor(min_y / ROAD_INDEX_CELL_SIZE_M), 0)
+        max_col = min(math.floor(max_x / ROAD_INDEX_CELL_SIZE_M), self.cols - 1)
+        max_row = min(math.floor(max_y / ROAD_INDEX_CELL_SIZE_M), self.rows - 1)
+        
+        return [
+            (row, col)
+            for row in range(min_row, max_row + 1)
+            for col in range(min_col, max_col + 1)
+        ]
+    
+    def nearest(self, lat, lon, radius_m):
+        """Ближайшая точка каждой дороги в радиусе: {way_id: (расстояние, lat, lon)}"""
+        px, py = self.project(lat, lon)
+        hits = {}
+        seen = set()
+        
+        for cell in self.cells_in_box(px - radius_m, py - radius_m, px + radius_m, py + radius_m):
+            for segment in self.cells.get(cell, ()):
+                if id(segment) in seen:
+                    continue
+                seen.add(id(segment))
+                
+                road_id, ax, ay, dx, dy, length2 = segment
+                t = ((px - ax) * dx + (py - ay) * dy) / length2 if length2 else 0.0
+                t = min(max(t, 0.0), 1.0)
+                sx, sy = ax + t * dx, ay + t * dy
+                distance = math.hypot(px - sx, py - sy)
+                
+                if distance <= radius_m and (road_id not in hits or distance < hits[road_id][0]):
+                    hits[road_id] = (distance, sx, sy)
+        
+        return {
+            road_id: (distance, *self.unproject(sx, sy))
+            for road_id, (distance, sx, sy) in hits.items()
+        }
+
+road_tile_index_cache = TTLCache(ROAD_TILE_TTL, max_entries=ROAD_TILE_CACHE_SIZE)
+
+def get_road_tile_index(tile):
+    """Индекс тайла, перестраивается, если в кэше тайлов появились новые данные"""
+    roads = road_tile_cache.get(tile)
+    if roads is None:
+        roads = fetch_road_tiles([tile])[tile]
+    
+    index = road_tile_index_cache.get(tile)
+    if index is None or index.source is not roads:
+        index = RoadTileIndex(tile, roads)
+        road_tile_index_cache.set(tile, index)
+    
+    return index
+
+def find_nearest_roads(lat, lon, radius_m, limit):
+    """Ближайшие к точке дороги в радиусе radius_m, отсортированные по расстоянию"""
+    d_lat = radius_m / (math.radians(1) * EARTH_RADIUS_M)
+    d_lon = d_lat / max(math.cos(math.radians(lat)), 0.01)
+    tiles = tiles_in_range(tile_range_for_bbox([lat - d_lat, lon - d_lon, lat + d_lat, lon + d_lon]))
+    
+    # Прогреваем кэш одним запросом для всех недостающих тайлов
+    load_road_tiles(tiles)
+    
+    best = {}
+    roads = {}
+    for tile in tiles:
+        index = get_road_tile_index(tile)
+        for road_id, hit in index.nearest(lat, lon, radius_m).items():
+            if road_id not in best or hit[0] < best[road_id][0]:
+                best[road_id] = hit
+                roads[road_id] = index.roads[road_id]
+    
+    nearest = sorted(best.items(), key=lambda item: item[1][0])[:limit]
+    
+    return [
+        {
+            'id': road_id,
+            'distance': round(distance, 1),
+            'point': {'lat': round(snap_lat, 7), 'lon': round(snap_lon, 7)},
+            'tags': roads[road_id]['tags']
+        }
+        for road_id, (distance, snap_lat, snap_lon) in nearest
+    ]
+
+class PrefetchScheduler:
+    """Фоновая предзагрузка тайлов вокруг просматриваемой области с учетом направления движения"""
+    
+    def __init__(self, workers, budget, budget_window, max_pending, max_age):
+        self.workers = workers
+        self.budget = budget
+        self.budget_window = budget_window
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        # Тайл -> (user_id, generation) актуальной задачи; записи очереди без пары здесь пропускаются
+        self._pending = {}
+        self._generation = {}
+        self._last_center = {}
+        self._spent = {}
+        self._lock = threading.Lock()
+        self._started = False
+    
+    def _start(self):
+        for _ in range(self.workers):
+            threading.Thread(target=self._worker, daemon=True).start()
+        self._started = True
+    
+    def _take_budget(self, user_id, now):
+        """Сколько тайлов пользователь ещё может поставить в очередь в текущем окне"""
+        window_start, spent = self._spent.get(user_id, (now, 0))
+        if now - window_start >= self.budget_window:
+            window_start, spent = now, 0
+        self._spent[user_id] = (window_start, spent)
+        return self.budget - spent
+    
+    def candidates(self, tile_range, direction):
+        """Соседние тайлы с приоритетами: по направлению движения — раньше остальных"""
+        min_row, min_col, max_row, max_col = tile_range
+        center_row = (min_row + max_row) / 2
+        center_col = (min_col + max_col) / 2
+        
+        ring = tiles_in_range((min_row - 1, min_col - 1, max_row + 1, max_col + 1))
+        ring = [
+            tile for tile in ring
+            if not (min_row <= tile[0] <= max_row and min_col <= tile[1] <= max_col)
+        ]
+        
+        if direction:
+            d_row, d_col = direction
+            # Ещё один слой тайлов дальше по ходу движения
+            ahead = tiles_in_range((
+                min_row - 1 + d_row,
+                min_col - 1 + d_col,
+                max_row + 1 + d_row,
+                max_col + 1 + d_col
+            ))
+            ring.extend(tile for tile in ahead if tile not in ring and not (
+                min_row - 1 <= tile[0] <= max_row + 1 and min_col - 1 <= tile[1] <= max_col + 1
+            ))
+        
+        def priority(tile):
+            if not direction:
+                return 1
+            offset = (tile[0] - center_row) * direction[0] + (tile[1] - center_col) * direction[1]
+            return 0 if offset > 0 else 1
+        
+        return sorted(ring, key=priority), priority
     
-    def get_way(self, way_id):
-        try:
-            response = self.session.get(f'{OSM_API_BASE}/api/0.6/way/{way_id}')
-            response.raise_for_status()
+    def schedule(self, user_id, bbox, tile_range):
+        center = ((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2)
+        
+        with self._lock:
+            last = self._last_center.get(user_id)
+            self._last_center[user_id] = center
             
-            root = ET.fromstring(response.text)
-            way_elem = root.find('way')
+            direction = None
+            if last:
+                d_lat = center[0] - last[0]
+                d_lon = center[1] - last[1]
+                # Смещение меньше четверти тайла считаем отсутствием движения
+                threshold = ROAD_TILE_SIZE / 4
+                direction = (
+                    (d_lat > threshold) - (d_lat < -threshold),
+                    (d_lon > threshold) - (d_lon < -threshold)
+                )
+                if direction == (0, 0):
+                    direction = None
             
-            way_data = {
-                'id': way_elem.get('id'),
-                'version': way_elem.get('version'),
-                'tags': {},
-                'nodes': []
+            # Новая область заменяет ещё не загруженные тайлы предыдущей области пользователя
+            generation = self._generation.get(user_id, 0) + 1
+            self._generation[user_id] = generation
+            self._pending = {
+                tile: owner for tile, owner in self._pending.items() if owner[0] != user_id
             }
             
-            for tag in way_elem.findall('tag'):
-                way_data['tags'][tag.get('k')] = tag.get('v')
+            tiles, priority = self.candidates(tile_range, direction)
+            now = time.monotonic()
+            budget = self._take_budget(user_id, now)
             
-            for nd in way_elem.findall('nd'):
-                way_data['nodes'].append(nd.get('ref'))
+            queued = 0
+            for tile in tiles:
+                if queued >= budget or len(self._pending) >= self.max_pending:
+                    break
+                if tile in self._pending or road_tile_cache.contains(tile):
+                    continue
+                
+                self._pending[tile] = (user_id, generation)
+                self._queue.put((priority(tile), next(self._counter), tile, user_id, generation, now))
+                queued += 1
             
-            return way_data
-        except Exception as e:
-            print(f"Ошибка получения дороги {way_id}: {e}")
-            return None
-    
-    def update_way(self, changeset_id, way_data):
-        way_xml = f'''<?xml version="1.0" encoding="UTF-8"?>
-<osm version="0.6" generator="OSM-Lane-Editor">
-  <way id="{way_data['id']}" version="{way_data['version']}" changeset="{changeset_id}">
-'''
-        
-        for node_id in way_data['nodes']:
-            way_xml += f'    <nd ref="{node_id}" />\n'
-        
-        for key, value in way_data['tags'].items():
-            value_escaped = value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
-            way_xml += f'    <tag k="{key}" v="{value_escaped}" />\n'
-        
-        way_xml += '  </way>\n</osm>'
-        
-        try:
-            response = self.session.put(
-                f'{OSM_API_BASE}/api/0.6/way/{way_data["id"]}',
-                data=way_xml,
-                headers={'Content-Type': 'text/xml'}
-            )
-            response.raise_for_status()
-            return int(response.text)
-        except Exception as e:
-            print(f"Ошибка обновления дороги {way_data['id']}: {e}")
-            return None
+            window_start, spent = self._spent[user_id]
+            self._spent[user_id] = (window_start, spent + queued)
+            
+            if queued and not self._started:
+                self._start()
     
-    def close_changeset(self, changeset_id):
-        try:
-            response = self.session.put(f'{OSM_API_BASE}/api/0.6/changeset/{changeset_id}/close')
-            response.raise_for_status()
-            return True
-        except Exception as e:
-            print(f"Ошибка закрытия changeset {changeset_id}: {e}")
-            return False
+    def _worker(self):
+        while True:
+            _, _, tile, user_id, generation, queued_at = self._queue.get()
+            owner = (user_id, generation)
+            try:
+                with self._lock:
+                    current = self._pending.get(tile) == owner
+                    if current and time.monotonic() - queued_at > self.max_age:
+                        del self._pending[tile]
+                        current = False
+                
+                # Пользователь уже ушел из этой области или задача устарела
+                if current and not road_tile_cache.contains(tile):
+                    fetch_road_tiles([tile], background=True)
+            except Exception as e:
+                print(f"Ошибка предзагрузки тайла {tile}: {e}")
+            finally:
+                with self._lock:
+                    if self._pending.get(tile) == owner:
+                        del self._pending[tile]
+                self._queue.task_done()
+
+prefetcher = PrefetchScheduler(
+    PREFETCH_WORKERS, PREFETCH_BUDGET_PER_USER, PREFETCH_BUDGET_WINDOW,
+    PREFETCH_MAX_PENDING, PREFETCH_MAX_AGE
+)
 
 def login_required(f):
     @wraps(f)
@@ -409,11 +1523,18 @@ def oauth_callback():
         if user_info:
             user_info['access_token'] = access_token
             user_info['refresh_token'] = token_response.get('refresh_token')
+            user_info['expires_at'] = token_expires_at(token_response)
             
             db.save_user(user_info)
             
-            session['user'] = user_info
-            session['access_token'] = access_token
+            # Токены остаются в БД, в сессии только публичные данные пользователя
+            session.pop('oauth_state', None)
+            session.regenerate()
+            session['user'] = {
+                'id': user_info['id'],
+                'username': user_info.get('username'),
+                'display_name': user_info.get('display_name')
+            }
             
             flash('Успешная авторизация!', 'success')
             return redirect(url_for('index'))
@@ -429,6 +1550,8 @@ def oauth_callback():
 @app.route('/logout')
 def logout():
     session.clear()
+    # Flash-сообщение снова сохранит сессию, поэтому выдаем ей новый id, как при входе
+    session.regenerate()
     flash('Вы вышли из системы', 'info')
     return redirect(url_for('login'))
 
@@ -485,43 +1608,53 @@ def load_roads_by_bbox():
         return jsonify({'error': 'Неверный формат bbox'}), 400
     
     try:
-        overpass_url = 'https://overpass-api.de/api/interpreter'
-        query = f"""
-        [out:json][timeout:25];
-        (
-          way["highway"]({bbox[0]},{bbox[1]},{bbox[2]},{bbox[3]});
-        );
-        out geom;
-        """
-        
-        headers = {'User-Agent': 'OSM-Lane-Editor/1.0'}
+        bbox = [float(value) for value in bbox]
+        tile_range = tile_range_for_bbox(bbox)
+        tiles = tiles_in_range(tile_range)
         
-        response = requests.post(overpass_url, data=query, timeout=30, headers=headers)
-        response.raise_for_status()
-        overpass_data = response.json()
+        if len(tiles) > MAX_TILES_PER_REQUEST:
+            roads = fetch_roads_from_overpass(bbox)
+        else:
+            # Тайлы шире области просмотра: отдаем только дороги, попадающие в сам bbox
+            roads = [road for road in load_road_tiles(tiles) if road_intersects_bbox(road, bbox)]
+            prefetcher.schedule(session['user']['id'], bbox, tile_range)
         
-        roads = []
+        return jsonify({
+            'success': True,
+            'roads': roads,
+            'total': len(roads)
+        })
         
-        for element in overpass_data.get('elements', []):
-            if element.get('type') == 'way' and 'geometry' in element:
-                geometry = element.get('geometry', [])
-                if len(geometry) < 2:
-                    continue
-                    
-                tags = element.get('tags', {})
-                highway_type = tags.get('highway', '')
-                
-                if highway_type in ['footway', 'path', 'steps', 'cycleway']:
-                    continue
-                
-                road = {
-                    'id': element['id'],
-                    'type': 'way',
-                    'geometry': geometry,
-                    'tags': tags
-                }
-                
-                roads.append(road)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/roads/nearest', methods=['GET'])
+@login_required
+def nearest_roads():
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    
+    if lat is None or lon is None or not -90 <= lat <= 90 or not -180 <= lon <= 180:
+        return jsonify({'error': 'Неверные координаты'}), 400
+    
+    # Разбираем сами: type= в request.args.get молча подставляет значение по умолчанию
+    try:
+        radius = float(request.args.get('radius', NEAREST_DEFAULT_RADIUS_M))
+        if not math.isfinite(radius):
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'Неверный радиус'}), 400
+    
+    try:
+        limit = int(request.args.get('limit', 5))
+    except ValueError:
+        return jsonify({'error': 'Неверный limit'}), 400
+    
+    radius = min(max(radius, 1), NEAREST_MAX_RADIUS_M)
+    limit = min(max(limit, 1), NEAREST_MAX_LIMIT)
+    
+    try:
+        roads = find_nearest_roads(lat, lon, radius, limit)
         
         return jsonify({
             'success': True,
@@ -536,7 +1669,6 @@ def load_roads_by_bbox():
 @login_required
 def get_way_details(way_id):
     try:
-        overpass_url = 'https://overpass-api.de/api/interpreter'
         query = f"""
         [out:xml][timeout:25];
         way({way_id});
@@ -544,7 +1676,8 @@ def get_way_details(way_id):
         """
         
         headers = {'User-Agent': 'OSM-Lane-Editor/1.0'}
-        response = requests.post(overpass_url, data=query, timeout=30, headers=headers)
+        overpass_limiter.wait()
+        response = requests.post(OVERPASS_URL, data=query, timeout=30, headers=headers)
         
         if response.status_code == 200:
             root = ET.fromstring(response.text)
@@ -566,7 +1699,7 @@ def get_way_details(way_id):
                 
                 return jsonify({'success': True, 'way': way_data})
         
-        access_token = session.get('access_token')
+        access_token = get_access_token(session['user']['id'])
         if access_token:
             osm_client = OSMAPIClient(access_token)
             way_data = osm_client.get_way(way_id)
@@ -578,6 +1711,45 @@ def get_way_details(way_id):
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def check_lane_tags(tags):
+    """Проверка тегов полос, возвращает (errors, warnings)"""
+    errors = []
+    warnings = []
+    
+    lanes_count = tags.get('lanes')
+    if lanes_count:
+        try:
+            lanes_int = int(lanes_count)
+            if lanes_int <= 0:
+                errors.append('Количество полос должно быть положительным числом')
+            elif lanes_int > 12:
+                warnings.append('Очень большое количество полос (>12)')
+        except ValueError:
+            errors.append('Количество полос должно быть числом')
+    
+    turn_lanes = tags.get('turn:lanes')
+    if turn_lanes and lanes_count:
+        turn_parts = turn_lanes.split('|')
+        try:
+            lanes_int = int(lanes_count)
+            if len(turn_parts) != lanes_int:
+                errors.append('Количество элементов в turn:lanes не соответствует количеству полос')
+        except ValueError:
+            pass
+    
+    if turn_lanes:
+        valid_turns = [
+            'left', 'through', 'right', 'reverse', 'slight_left', 'slight_right', 
+            'sharp_left', 'sharp_right', 'merge_to_left', 'merge_to_right', 'none'
+        ]
+        for part in turn_lanes.split('|'):
+            if part:
+                for turn in part.split(';'):
+                    if turn and turn not in valid_turns:
+                        warnings.append(f'Неизвестное направление поворота: {turn}')
+    
+    return errors, warnings
+
 @app.route('/api/validate/lanes', methods=['POST'])
 @login_required
 def validate_lanes():
@@ -585,40 +1757,7 @@ def validate_lanes():
         data = request.json
         tags = data.get('tags', {})
         
-        errors = []
-        warnings = []
-        
-        lanes_count = tags.get('lanes')
-        if lanes_count:
-            try:
-                lanes_int = int(lanes_count)
-                if lanes_int <= 0:
-                    errors.append('Количество полос должно быть положительным числом')
-                elif lanes_int > 12:
-                    warnings.append('Очень большое количество полос (>12)')
-            except ValueError:
-                errors.append('Количество полос должно быть числом')
-        
-        turn_lanes = tags.get('turn:lanes')
-        if turn_lanes and lanes_count:
-            turn_parts = turn_lanes.split('|')
-            try:
-                lanes_int = int(lanes_count)
-                if len(turn_parts) != lanes_int:
-                    errors.append('Количество элементов в turn:lanes не соответствует количеству полос')
-            except ValueError:
-                pass
-        
-        if turn_lanes:
-            valid_turns = [
-                'left', 'through', 'right', 'reverse', 'slight_left', 'slight_right', 
-                'sharp_left', 'sharp_right', 'merge_to_left', 'merge_to_right', 'none'
-            ]
-            for part in turn_lanes.split('|'):
-                if part:
-                    for turn in part.split(';'):
-                        if turn and turn not in valid_turns:
-                            warnings.append(f'Неизвестное направление поворота: {turn}')
+        errors, warnings = check_lane_tags(tags)
         
         return jsonify({
             'valid': len(errors) == 0,
@@ -629,6 +1768,333 @@ def validate_lanes():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+osm_api_limiter = RateLimiter(OSM_API_MIN_INTERVAL)
+
+IMPORT_WAY_ID_FIELDS = ('way_id', 'osm_way_id', '@id', 'id')
+
+def parse_way_id(value):
+    """Id дороги из значений вида 123, w123, way/123"""
+    if value is None:
+        return None
+    
+    value = str(value).strip()
+    if value.startswith('way/'):
+        value = value[4:]
+    elif value[:1] in ('w', 'W'):
+        value = value[1:]
+    
+    try:
+        way_id = int(value)
+    except ValueError:
+        return None
+    
+    return way_id if way_id > 0 else None
+
+def is_lane_tag(key):
+    """Теги полос: lanes, turn:lanes, lanes:*, *:lanes"""
+    return 'lanes' in key.split(':')
+
+def split_import_record(record):
+    """Разделение записи импорта на id дороги, теги полос и ошибки"""
+    way_id = None
+    tags = {}
+    errors = []
+    
+    for key, value in record.items():
+        if key is None:
+            continue
+        if key in IMPORT_WAY_ID_FIELDS:
+            if way_id is None:
+                way_id = value
+            continue
+        # Служебные поля выгрузок (@relations, @timestamp...) и вложенные значения не теги
+        if key.startswith('@') or not isinstance(value, (str, int, float)) or isinstance(value, bool):
+            continue
+        if str(value).strip() == '':
+            continue
+        if not is_lane_tag(key):
+            errors.append(f'Недопустимый тег: {key} (разрешены только теги полос)')
+            continue
+        tags[key] = str(value).strip()
+    
+    return way_id, tags, errors
+
+def iter_csv_changes(stream):
+    """Построчное чтение CSV: колонка way_id и по колонке на каждый тег"""
+    reader = csv.DictReader(stream)
+    for record in reader:
+        way_id, tags, errors = split_import_record(record)
+        yield reader.line_num, way_id, tags, errors
+
+def parse_geojson_feature(feature):
+    """Id дороги, теги и ошибки из одного объекта Feature"""
+    if not isinstance(feature, dict):
+        return None, {}, ['Объект не является GeoJSON Feature']
+    
+    properties = feature.get('properties') or {}
+    if not isinstance(properties, dict):
+        return feature.get('id'), {}, ['properties должно быть объектом']
+    
+    way_id, tags, errors = split_import_record(properties)
+    return way_id if way_id is not None else feature.get('id'), tags, errors
+
+def iter_geojson_changes(stream):
+    """Чтение GeoJSON: построчно (GeoJSON Sequence) либо целиком (FeatureCollection)"""
+    first_line = stream.readline()
+    stripped = first_line.strip().lstrip('\x1e')
+    
+    if not stripped.startswith('{') or not stripped.endswith('}') or '"FeatureCollection"' in stripped:
+        # FeatureCollection без внешних зависимостей потоково не разобрать
+        try:
+            data = json.loads(first_line + stream.read())
+        except ValueError as e:
+            yield 1, None, {}, [f'Неверный GeoJSON: {e}']
+            return
+        
+        features = data.get('features') if isinstance(data, dict) else None
+        if not isinstance(features, list):
+            yield 1, None, {}, ['Ожидается FeatureCollection со списком features']
+            return
+        
+        for index, feature in enumerate(features, start=1):
+            yield (index, *parse_geojson_feature(feature))
+        return
+    
+    for line_no, line in enumerate(itertools.chain([first_line], stream), start=1):
+        line = line.strip().lstrip('\x1e')
+        if not line:
+            continue
+        
+        try:
+            feature = json.loads(line)
+        except ValueError as e:
+            yield line_no, None, {}, [f'Неверный JSON: {e}']
+            continue
+        
+        yield (line_no, *parse_geojson_feature(feature))
+
+def detect_import_format(filename):
+    extension = os.path.splitext(filename or '')[1].lower()
+    if extension == '.csv':
+        return 'csv'
+    if extension in ('.geojson', '.geojsonl', '.geojsons', '.json', '.ndjson'):
+        return 'geojson'
+    return None
+
+def iter_import_changes(stream, file_format):
+    if file_format == 'csv':
+        return iter_csv_changes(stream)
+    return iter_geojson_changes(stream)
+
+def plan_import(user_id, records, comment):
+    """Проверка записей импорта и раскладка их по changeset с учетом лимита OSM"""
+    import_id = uuid.uuid4().hex
+    changeset_ids = []
+    errors = []
+    chunk = []
+    total = 0
+    invalid = 0
+    
+    def flush():
+        if not chunk:
+            return
+        changeset_id = db.save_changeset(user_id, comment, chunk, import_id=import_id)
+        if not changeset_id:
+            raise RuntimeError('Ошибка сохранения changeset')
+        changeset_ids.append(changeset_id)
+        chunk.clear()
+    
+    try:
+        for line_no, raw_way_id, tags, row_errors in records:
+            way_id = parse_way_id(raw_way_id)
+            
+            if not row_errors:
+                if way_id is None:
+                    row_errors = ['Неверный id дороги']
+                elif not tags:
+                    row_errors = ['Нет тегов для изменения']
+                else:
+                    row_errors = check_lane_tags(tags)[0]
+            
+            if row_errors:
+                invalid += 1
+                if len(errors) < IMPORT_MAX_REPORTED_ERRORS:
+                    errors.append({'line': line_no, 'way_id': raw_way_id, 'errors': row_errors})
+                continue
+            
+            chunk.append({'way_id': way_id, 'new_tags': tags})
+            total += 1
+            
+            if len(chunk) >= OSM_CHANGESET_MAX_ELEMENTS:
+                flush()
+    except (ValueError, csv.Error) as e:
+        # Файл не дочитан (например, битая кодировка): уже сохраненные части остаются
+        # доступны для отправки и возобновления по import_id
+        invalid += 1
+        errors.append({'line': None, 'way_id': None, 'errors': [f'Ошибка чтения файла: {e}']})
+    
+    flush()
+    
+    return {
+        'import_id': import_id,
+        'changesets': changeset_ids,
+        'total': total,
+        'invalid': invalid,
+        'errors': errors
+    }
+
+def upload_import_changeset(changeset, osm_id):
+    """Отправка в OSM всех ещё не отправленных изменений локального changeset"""
+    pending = db.get_unsent_road_changes(changeset['id'])
+    if not pending:
+        db.update_changeset_status(changeset['id'], 'sent')
+        return
+    
+    access_token = get_access_token(osm_id)
+    if not access_token:
+        print(f"Нет токена для импорта changeset {changeset['id']}")
+        return
+    
+    osm_client = OSMAPIClient(access_token)
+    
+    # При возобновлении открываем новый changeset: прежний мог быть закрыт OSM по таймауту
+    osm_api_limiter.wait()
+    osm_changeset_id = osm_client.create_changeset(changeset['comment'])
+    if not osm_changeset_id:
+        db.update_changeset_status(changeset['id'], 'failed')
+        return
+    
+    db.update_changeset_status(changeset['id'], 'uploading', osm_changeset_id)
+    
+    failed = 0
+    for start in range(0, len(pending), IMPORT_UPLOAD_BATCH):
+        failed += upload_import_batch(osm_client, osm_changeset_id, pending[start:start + IMPORT_UPLOAD_BATCH])
+    
+    osm_api_limiter.wait()
+    osm_client.close_changeset(osm_changeset_id)
+    db.update_changeset_status(changeset['id'], 'partial' if failed else 'sent')
+
+def effective_changes(changes):
+    """Для строк одной дороги — теги, которые не перезаписаны более поздними строками"""
+    seen_keys = set()
+    result = []
+    
+    for change in reversed(changes):
+        tags = {key: value for key, value in change['new_tags'].items() if key not in seen_keys}
+        seen_keys.update(change['new_tags'])
+        result.append((change, tags))
+    
+    return list(reversed(result))
+
+def upload_import_batch(osm_client, osm_changeset_id, batch):
+    """Отправка порции изменений: одна загрузка дорог и один osmChange, возвращает число ошибок"""
+    changes_by_way = {}
+    for change in batch:
+        changes_by_way.setdefault(change['way_id'], []).append(change)
+    
+    osm_api_limiter.wait()
+    ways = osm_client.get_ways(list(changes_by_way))
+    if ways is None:
+        # Пакетный запрос не удался (например, одной из дорог нет): загружаем по одной
+        ways = {}
+        for way_id in changes_by_way:
+            osm_api_limiter.wait()
+            way_data = osm_client.get_way(way_id)
+            if way_data:
+                ways[way_id] = way_data
+    
+    updates = []
+    modified = []
+    for way_id, changes in changes_by_way.items():
+        way_data = ways.get(way_id)
+        if not way_data:
+            updates.extend((change['id'], {}, 'failed', None) for change in changes)
+            continue
+        
+        # Несколько строк для одной дороги объединяются в одну правку
+        old_tags = way_data['tags'].copy()
+        for change in changes:
+            way_data['tags'].update(change['new_tags'])
+        
+        # Строки проверялись по отдельности, а в OSM уходит итоговый набор тегов дороги
+        errors, _ = check_lane_tags(way_data['tags'])
+        if errors:
+            print(f"Дорога {way_id} не отправлена: {'; '.join(errors)}")
+            updates.extend((change['id'], old_tags, 'failed', None) for change in changes)
+            continue
+        
+        modified.append((way_data, old_tags, effective_changes(changes)))
+    
+    if modified:
+        osm_api_limiter.wait()
+        if osm_client.upload_changes(osm_changeset_id, [way_data for way_data, _, _ in modified]):
+            for _, old_tags, changes in modified:
+                updates.extend(
+                    (change['id'], old_tags, 'sent' if tags else 'superseded', tags)
+                    for change, tags in changes
+                )
+        else:
+            # Загрузка атомарна: при ошибке отправляем дороги по одной, чтобы отсеять проблемные
+            for way_data, old_tags, changes in modified:
+                osm_api_limiter.wait()
+                status = 'sent' if osm_client.update_way(osm_changeset_id, way_data) else 'failed'
+                updates.extend(
+                    (change['id'], old_tags, 'superseded' if status == 'sent' and not tags else status, tags)
+                    for change, tags in changes
+                )
+    
+    db.update_road_changes(updates, osm_changeset_id)
+    
+    # Теги этих дорог в кэше тайлов устарели
+    sent_ids = {road_change_id for road_change_id, _, status, _ in updates if status != 'failed'}
+    invalidate_road_tiles([
+        way_data['id'] for way_data, _, changes in modified
+        if any(change['id'] in sent_ids for change, _ in changes)
+    ])
+    return sum(1 for _, _, status, _ in updates if status == 'failed')
+
+class ImportRunner:
+    """Фоновая очередь отправки changeset массового импорта"""
+    
+    def __init__(self, workers):
+        self.workers = workers
+        self._queue = queue.Queue()
+        self._active = set()
+        self._lock = threading.Lock()
+        self._started = False
+    
+    def enqueue(self, import_id, user_id, osm_id):
+        queued = 0
+        with self._lock:
+            for changeset in db.get_import_changesets(import_id, user_id):
+                if changeset['status'] == 'sent' or changeset['id'] in self._active:
+                    continue
+                self._active.add(changeset['id'])
+                self._queue.put((changeset, osm_id))
+                queued += 1
+            
+            if queued and not self._started:
+                for _ in range(self.workers):
+                    threading.Thread(target=self._worker, daemon=True).start()
+                self._started = True
+        
+        return queued
+    
+    def _worker(self):
+        while True:
+            changeset, osm_id = self._queue.get()
+            try:
+                upload_import_changeset(changeset, osm_id)
+            except Exception as e:
+                print(f"Ошибка импорта changeset {changeset['id']}: {e}")
+                db.update_changeset_status(changeset['id'], 'failed')
+            finally:
+                with self._lock:
+                    self._active.discard(changeset['id'])
+                self._queue.task_done()
+
+import_runner = ImportRunner(IMPORT_WORKERS)
+
 @app.route('/api/changeset/create', methods=['POST'])
 @login_required
 def create_changeset():
@@ -640,12 +2106,12 @@ def create_changeset():
         if not changes:
             return jsonify({'error': 'Нет изменений для отправки'}), 400
         
-        access_token = session.get('access_token')
+        user = session.get('user')
+        access_token = get_access_token(user['id'])
         if not access_token:
             return jsonify({'error': 'Нет токена авторизации'}), 401
             
         osm_client = OSMAPIClient(access_token)
-        user = session.get('user')
         
         changeset_id = osm_client.create_changeset(comment)
         if not changeset_id:
@@ -675,9 +2141,13 @@ def create_changeset():
         
         osm_client.close_changeset(changeset_id)
         
+        # Теги этих дорог в кэше тайлов устарели после правки
+        invalidate_road_tiles([way['way_id'] for way in updated_ways])
+        
         user_db = db.get_user_by_osm_id(user['id'])
         if user_db:
-            changeset_local_id = db.save_changeset(user_db['id'], comment, changes)
+            # В историю попадают только реально обновленные дороги со старыми тегами из OSM
+            changeset_local_id = db.save_changeset(user_db['id'], comment, updated_ways)
             
             conn = db.get_connection()
             cursor = conn.cursor()
@@ -686,6 +2156,9 @@ def create_changeset():
                 SET osm_changeset_id = ?, status = 'sent', sent_at = CURRENT_TIMESTAMP
                 WHERE id = ?
             ''', (changeset_id, changeset_local_id))
+            cursor.execute('''
+                UPDATE road_changes SET osm_changeset_id = ? WHERE changeset_id = ?
+            ''', (changeset_id, changeset_local_id))
             conn.commit()
             conn.close()
         
@@ -713,7 +2186,8 @@ def get_history():
         cursor = conn.cursor()
         
         cursor.execute('''
-            SELECT c.*, COUNT(rc.id) as changes_count
+            SELECT c.*, COUNT(rc.id) as changes_count,
+                   GROUP_CONCAT(DISTINCT rc.osm_changeset_id) as osm_changeset_ids
             FROM changesets c
             LEFT JOIN road_changes rc ON c.id = rc.changeset_id
             WHERE c.user_id = ?
@@ -735,6 +2209,7 @@ def get_history():
                 'osm_changeset_id': changeset_data['osm_changeset_id'],
                 'comment': changeset_data['comment'],
                 'status': changeset_data['status'],
+                'osm_changeset_ids': parse_id_list(changeset_data['osm_changeset_ids']),
                 'changes_count': changeset_data['changes_count'],
                 'created_at': changeset_data['created_at'],
                 'sent_at': changeset_data['sent_at']
@@ -747,6 +2222,195 @@ def get_history():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+HISTORY_EXPORT_FIELDS = [
+    'id', 'changeset_id', 'osm_changeset_id', 'status', 'osm_way_id', 'tag_key',
+    'old_value', 'new_value', 'created_at', 'sent_at', 'display_name'
+]
+
+@app.route('/api/history/edits')
+@login_required
+def get_tag_edits():
+    try:
+        way_id = request.args.get('way_id', type=int)
+        tag_key = request.args.get('key')
+        after_id = request.args.get('after_id', 0, type=int)
+        limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+        
+        edits = db.get_tag_edits(way_id, tag_key, after_id, limit)
+        
+        return jsonify({
+            'edits': edits,
+            'next_after_id': edits[-1]['id'] if len(edits) == limit else None
+        })
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/history/export')
+@login_required
+def export_history():
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'error': 'Поддерживаются форматы ndjson и csv'}), 400
+    
+    way_id = request.args.get('way_id', type=int)
+    tag_key = request.args.get('key')
+    
+    def generate_ndjson():
+        for edit in db.iter_tag_edits(way_id, tag_key):
+            yield json.dumps(edit, ensure_ascii=False) + '\n'
+    
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=HISTORY_EXPORT_FIELDS)
+        writer.writeheader()
+        
+        for edit in db.iter_tag_edits(way_id, tag_key):
+            writer.writerow(edit)
+            if buffer.tell() > 65536:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        
+        yield buffer.getvalue()
+    
+    if export_format == 'csv':
+        generator, mimetype = generate_csv(), 'text/csv'
+    else:
+        generator, mimetype = generate_ndjson(), 'application/x-ndjson'
+    
+    return Response(
+        stream_with_context(generator),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=lane_edits.{export_format}'}
+    )
+
+@app.route('/api/import', methods=['POST'])
+@login_required
+def import_lanes():
+    upload = request.files.get('file')
+    if not upload:
+        return jsonify({'error': 'Файл не передан'}), 400
+    
+    file_format = request.form.get('format') or detect_import_format(upload.filename)
+    if file_format not in ('csv', 'geojson'):
+        return jsonify({'error': 'Поддерживаются только CSV и GeoJSON'}), 400
+    
+    try:
+        user = session.get('user')
+        user_db = db.get_user_by_osm_id(user['id'])
+        if not user_db:
+            return jsonify({'error': 'Пользователь не найден'}), 401
+        
+        comment = request.form.get('comment', 'Обновление полос движения')
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        result = plan_import(user_db['id'], iter_import_changes(stream, file_format), comment)
+        
+        import_runner.enqueue(result['import_id'], user_db['id'], user['id'])
+        
+        return jsonify({'success': True, **result})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def parse_id_list(value):
+    """Список id из результата GROUP_CONCAT"""
+    return sorted(int(item) for item in value.split(',')) if value else []
+
+def import_status(import_id, changesets):
+    progress = db.get_import_progress(import_id)
+    return {
+        'import_id': import_id,
+        'changesets': [
+            {
+                'id': changeset['id'],
+                'osm_changeset_id': changeset['osm_changeset_id'],
+                'osm_changeset_ids': parse_id_list(changeset['osm_changeset_ids']),
+                'status': changeset['status']
+            }
+            for changeset in changesets
+        ],
+        'pending': progress.get('pending', 0),
+        'sent': progress.get('sent', 0),
+        'failed': progress.get('failed', 0),
+        'superseded': progress.get('superseded', 0)
+    }
+
+@app.route('/api/import/<import_id>')
+@login_required
+def get_import(import_id):
+    try:
+        user = session.get('user')
+        user_db = db.get_user_by_osm_id(user['id'])
+        changesets = db.get_import_changesets(import_id, user_db['id']) if user_db else []
+        
+        if not changesets:
+            return jsonify({'error': 'Импорт не найден'}), 404
+        
+        return jsonify(import_status(import_id, changesets))
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/import/<import_id>/resume', methods=['POST'])
+@login_required
+def resume_import(import_id):
+    try:
+        user = session.get('user')
+        user_db = db.get_user_by_osm_id(user['id'])
+        if not user_db or not db.get_import_changesets(import_id, user_db['id']):
+            return jsonify({'error': 'Импорт не найден'}), 404
+        
+        queued = import_runner.enqueue(import_id, user_db['id'], user['id'])
+        return jsonify({'success': True, 'queued_changesets': queued})
+        
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.cli.command('import-lanes')
+@click.argument('path', required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option('--user', 'osm_id', type=int, required=True, help='OSM id пользователя, от имени которого идет загрузка')
+@click.option('--comment', default='Обновление полос движения', help='Комментарий changeset')
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'geojson']), help='Формат файла (по умолчанию по расширению)')
+@click.option('--resume', 'resume_id', help='Продолжить ранее начатый импорт')
+def import_lanes_command(path, osm_id, comment, file_format, resume_id):
+    """Массовая загрузка тегов полос из CSV/GeoJSON"""
+    user_db = db.get_user_by_osm_id(osm_id)
+    if not user_db:
+        raise click.ClickException('Пользователь не найден, сначала войдите через веб-интерфейс')
+    
+    if resume_id:
+        import_id = resume_id
+    else:
+        if not path:
+            raise click.ClickException('Укажите файл или --resume')
+        
+        file_format = file_format or detect_import_format(path)
+        if not file_format:
+            raise click.ClickException('Не удалось определить формат файла, укажите --format')
+        
+        with open(path, encoding='utf-8-sig', newline='') as stream:
+            result = plan_import(user_db['id'], iter_import_changes(stream, file_format), comment)
+        
+        import_id = result['import_id']
+        click.echo(f"📦 Импорт {import_id}: {result['total']} изменений, "
+                   f"{len(result['changesets'])} changeset, ошибок: {result['invalid']}")
+        for error in result['errors']:
+            click.echo(f"   • строка {error['line']} ({error['way_id']}): {'; '.join(error['errors'])}")
+    
+    changesets = db.get_import_changesets(import_id, user_db['id'])
+    if not changesets:
+        raise click.ClickException('Импорт не найден')
+    
+    for changeset in changesets:
+        if changeset['status'] == 'sent':
+            continue
+        click.echo(f"🚀 Отправка changeset {changeset['id']}...")
+        upload_import_changeset(changeset, osm_id)
+    
+    status = import_status(import_id, db.get_import_changesets(import_id, user_db['id']))
+    click.echo(f"✅ Отправлено: {status['sent']}, ошибок: {status['failed']}, осталось: {status['pending']}")
+
 if __name__ == '__main__':
     print("🚀 Запуск OSM Lane Editor...")
     